@@ -15,3 +15,19 @@ def preload(parser: ArgumentParser):
         help='Path to directory with DeepDanbooru project(s).',
         default=Path(models_path, 'deepdanbooru')
     )
+
+    parser.add_argument(
+        '--tagger-workers',
+        type=int,
+        default=1,
+        help='Number of worker processes to shard batch tagging across. '
+             'Only used by the Waifu Diffusion tagger on CPU.'
+    )
+
+    parser.add_argument(
+        '--wd14-quantize',
+        type=str,
+        choices=['none', 'fp16', 'int8'],
+        default='none',
+        help='Quantize the Waifu Diffusion tagger ONNX model for faster inference.'
+    )
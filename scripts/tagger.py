@@ -1,29 +1,83 @@
 import os
+import sys
 import json
+import hashlib
+import numpy as np
 import gradio as gr
 
 from typing import List, Dict
 from pathlib import Path
-from glob import glob
+from collections import deque
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed)
+from multiprocessing import get_context
+from threading import BoundedSemaphore
 from PIL import Image, ImageFile, UnidentifiedImageError
 
 from webui import wrap_gradio_gpu_call
 from modules import shared, scripts, script_callbacks, ui
 from modules import generation_parameters_copypaste as parameters_copypaste
 
+# orjson serializes the big tag dicts several times faster than the
+# stdlib, but it's fine to run without it
+try:
+    import orjson
+
+    def json_dumps(obj) -> bytes:
+        return orjson.dumps(obj)
+except ImportError:
+    def json_dumps(obj) -> bytes:
+        return json.dumps(obj, separators=(',', ':')).encode('utf-8')
+
 from tagger import format
+from tagger import worker
 from tagger.preset import Preset
-from tagger.interrogator import Interrogator, DeepDanbooruInterrogator, WaifuDiffusionInterrogator
+from tagger.interrogator import (
+    Interrogator, DeepDanbooruInterrogator, WaifuDiffusionInterrogator,
+    use_cpu)
 from tagger.utils import split_str
 
 script_dir = Path(scripts.basedir())
+
+# the webui only keeps the extension root on sys.path while it loads the
+# extension scripts, but processes spawned for --tagger-workers have to
+# import tagger.worker with whatever sys.path exists at click time, so
+# register the root permanently
+if str(script_dir) not in sys.path:
+    sys.path.append(str(script_dir))
+
 preset = Preset(script_dir.joinpath('presets'))
 interrogators: Dict[str, Interrogator] = {}
 
+# instances kept across refreshes; DeepDanbooru entries are keyed by
+# project.json mtime so only changed projects are rebuilt
+_wd14_cache: Dict[str, WaifuDiffusionInterrogator] = {}
+_dd_cache: Dict[str, tuple] = {}
+
 # if you do not initialize the Image object
 # Image.registered_extensions() returns only PNG
 Image.init()
 
+# extensions PIL can open, without the dot; see refresh_supported_exts
+supported_extensions = frozenset()
+
+
+def refresh_supported_exts() -> frozenset:
+    # recomputed on refresh so formats registered by plugins loaded after
+    # this module (e.g. pillow-avif) are picked up too
+    global supported_extensions
+
+    supported_extensions = frozenset(
+        e[1:].lower()
+        for e, f in Image.registered_extensions().items()
+        if f in Image.OPEN
+    )
+
+    return supported_extensions
+
+
+refresh_supported_exts()
+
 # PIL spits errors when loading a truncated image by default
 # https://pillow.readthedocs.io/en/stable/reference/ImageFile.html#PIL.ImageFile.LOAD_TRUNCATED_IMAGES
 ImageFile.LOAD_TRUNCATED_IMAGES = True
@@ -33,11 +87,17 @@ def refresh_interrogators() -> List[str]:
     global interrogators
     interrogators = {}
 
+    # other extensions may have registered new Pillow plugins by now
+    refresh_supported_exts()
+
     # load waifu diffusion 1.4 tagger models
-    interrogators['wd14-vit'] = WaifuDiffusionInterrogator()
-    interrogators['wd14-convnext'] = WaifuDiffusionInterrogator(
-        repo='SmilingWolf/wd-v1-4-convnext-tagger'
-    )
+    if not _wd14_cache:
+        _wd14_cache['wd14-vit'] = WaifuDiffusionInterrogator()
+        _wd14_cache['wd14-convnext'] = WaifuDiffusionInterrogator(
+            repo='SmilingWolf/wd-v1-4-convnext-tagger'
+        )
+
+    interrogators.update(_wd14_cache)
 
     # load deepdanbooru project
     os.makedirs(
@@ -49,14 +109,47 @@ def refresh_interrogators() -> List[str]:
         if not path.is_dir():
             continue
 
-        if not Path(path, 'project.json').is_file():
+        project_file = Path(path, 'project.json')
+        if not project_file.is_file():
             continue
 
-        interrogators[path.name] = DeepDanbooruInterrogator(path)
+        # reuse the existing interrogator unless the project changed
+        mtime = project_file.stat().st_mtime
+        cached = _dd_cache.get(path.path)
+
+        if cached is None or cached[0] != mtime:
+            cached = (mtime, DeepDanbooruInterrogator(path))
+            _dd_cache[path.path] = cached
+
+        interrogators[path.name] = cached[1]
 
     return sorted(interrogators.keys())
 
 
+def _iter_images(root: os.PathLike, recursive: bool, exts: set):
+    # os.scandir keeps the walk lazy: no upfront list of 100k paths,
+    # and the extension check runs on entry.name without a Path object
+    try:
+        entries = os.scandir(root)
+    except OSError as error:
+        # unreadable directories are skipped, like glob did
+        print(f'cannot scan {root}: {error}')
+        return
+
+    with entries:
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+
+            if is_dir:
+                if recursive:
+                    yield from _iter_images(entry.path, recursive, exts)
+            elif entry.name.rpartition('.')[2].lower() in exts:
+                yield Path(entry.path)
+
+
 def on_ui_tabs():
     with gr.Blocks(analytics_enabled=False) as tagger_interface:
         with gr.Row().style(equal_height=False):
@@ -96,7 +189,6 @@ def on_ui_tabs():
                             value='[name].[output_extension]'
                         )
 
-                        import hashlib
                         with gr.Accordion(
                             label='Output filename formats',
                             open=False
@@ -138,6 +230,15 @@ def on_ui_tabs():
                             label='Save with JSON'
                         )
 
+                        batch_size = preset.component(
+                            gr.Slider,
+                            label='Batch size',
+                            minimum=1,
+                            maximum=32,
+                            step=1,
+                            value=8
+                        )
+
                 submit = gr.Button(
                     value='Interrogate',
                     variant='primary'
@@ -278,6 +379,7 @@ def on_ui_tabs():
             batch_output_filename_format: str,
             batch_output_action_on_conflict: str,
             batch_output_save_json: bool,
+            batch_size: int,
 
             interrogator: str,
             threshold: float,
@@ -340,67 +442,138 @@ def on_ui_tabs():
                 if not os.path.isdir(base_dir):
                     return ['', None, None, 'input path is not a directory']
 
-                # this line is moved here because some reason
-                # PIL.Image.registered_extensions() returns only PNG if you call too early
-                supported_extensions = [
-                    e
-                    for e, f in Image.registered_extensions().items()
-                    if f in Image.OPEN
-                ]
+                # stay lazy: counting the images up front would force the
+                # whole directory walk before the first tag is produced
+                paths = _iter_images(
+                    base_dir,
+                    batch_input_recursive,
+                    supported_extensions
+                )
 
-                paths = [
-                    Path(p)
-                    for p in glob(batch_input_glob, recursive=batch_input_recursive)
-                    if '.' + p.split('.').pop().lower() in supported_extensions
-                ]
+                processed = 0
 
-                print(f'found {len(paths)} image(s)')
+                # the format string is constant across the batch,
+                # so parse it only once
+                format_segments = format.compile(batch_output_filename_format)
 
-                for path in paths:
-                    try:
-                        image = Image.open(path)
-                    except UnidentifiedImageError:
-                        # just in case, user has mysterious file...
-                        print(f'${path} is not supported image type')
-                        continue
+                # a format string without substitution tokens yields the
+                # same name for every image; skip the per-image formatting
+                static_format = all(isinstance(s, str) for s in format_segments)
+
+                # output-path invariants, hoisted out of the per-image loop
+                base_len = len(Path(base_dir).parts)
+                output_root = Path(batch_output_dir) if batch_output_dir else Path(base_dir)
+
+                batch_size = max(int(batch_size), 1)
+
+                # output files already claimed by an earlier image in this
+                # run; their writes may still be queued on the writer thread,
+                # so an existence check alone would miss them
+                claimed_outputs = set()
+
+                def resolve_output(path):
+                    # returns (output path, existing output) or None to skip
+                    # the image entirely, before it is ever decoded
 
                     # guess the output path
-                    base_dir_last = Path(base_dir).parts[-1]
-                    base_dir_last_idx = path.parts.index(base_dir_last)
-                    output_dir = Path(batch_output_dir) if batch_output_dir else Path(base_dir)
-                    output_dir = output_dir.joinpath(*path.parts[base_dir_last_idx + 1:]).parent
+                    rel_parts = path.parts[base_len:]
+                    output_dir = output_root.joinpath(*rel_parts).parent
 
                     output_dir.mkdir(0o777, True, True)
 
                     # format output filename
-                    format_info = format.Info(path, 'txt')
+                    if static_format:
+                        formatted_output_filename = batch_output_filename_format
+                    else:
+                        format_info = format.Info(path, 'txt')
 
-                    try:
-                        formatted_output_filename = format.pattern.sub(
-                            lambda m: format.format(m, format_info),
-                            batch_output_filename_format
+                        formatted_output_filename = ''.join(
+                            s if isinstance(s, str) else s(format_info)
+                            for s in format_segments
                         )
-                    except (TypeError, ValueError) as error:
-                        return ['', None, None, str(error)]
 
                     output_path = output_dir.joinpath(
                         formatted_output_filename
                     )
 
+                    # decide the conflict before decoding, so
+                    # already-tagged images cost a stat, not a decode
+                    if batch_output_action_on_conflict == 'ignore':
+                        if (
+                            output_path in claimed_outputs
+                            or output_path.is_file()
+                        ):
+                            print(f'skipping {path}')
+                            return None
+
+                        claimed_outputs.add(output_path)
+
+                    return output_path
+
+                # a single background thread takes the caption/JSON writes
+                # off the inference path; one worker keeps them in order
+                writer = ThreadPoolExecutor(max_workers=1)
+
+                # bound the writer queue so a slow disk applies back-pressure
+                # to the inference loop instead of queueing captions for the
+                # whole run
+                write_slots = BoundedSemaphore(batch_size * 2)
+                write_futures = deque()
+                write_errors: List[BaseException] = []
+
+                def drain_writes():
+                    # collect finished writes as we go; only failures
+                    # are kept around
+                    while write_futures and write_futures[0].done():
+                        error = write_futures.popleft().exception()
+
+                        if error is not None:
+                            write_errors.append(error)
+
+                def submit_write(func, *args):
+                    drain_writes()
+
+                    write_slots.acquire()
+                    future = writer.submit(func, *args)
+                    future.add_done_callback(lambda _: write_slots.release())
+                    write_futures.append(future)
+
+                def first_write_error():
+                    # a failed write (read-only dir, disk full...) must not
+                    # let the run report success
+                    while write_futures:
+                        error = write_futures.popleft().exception()
+
+                        if error is not None:
+                            write_errors.append(error)
+
+                    return str(write_errors[0]) if write_errors else None
+
+                def write_caption(output_path, plain_tags):
+                    # runs on the writer thread: reading the existing caption
+                    # here keeps it ordered after earlier writes, so two
+                    # inputs mapping to the same output file (e.g. duplicate
+                    # images with a [hash:...] format) append correctly
                     output = []
 
-                    if output_path.is_file():
+                    if (
+                        batch_output_action_on_conflict in ('append', 'prepend')
+                        and output_path.is_file()
+                    ):
                         output.append(output_path.read_text())
 
-                        if batch_output_action_on_conflict == 'ignore':
-                            print(f'skipping {path}')
-                            continue
+                    if batch_output_action_on_conflict == 'prepend':
+                        output.insert(0, plain_tags)
+                    else:
+                        output.append(plain_tags)
 
-                    ratings, tags = interrogator.interrogate(image)
-                    processed_tags = Interrogator.postprocess_tags(
-                        tags,
-                        *postprocess_opts
-                    )
+                    output_path.write_text(' '.join(output))
+
+                def write_result(
+                    path, output_path, ratings, tags, processed_tags
+                ):
+                    nonlocal processed
+                    processed += 1
 
                     # TODO: switch for less print
                     print(
@@ -409,21 +582,226 @@ def on_ui_tabs():
 
                     plain_tags = ', '.join(processed_tags)
 
-                    if batch_output_action_on_conflict == 'copy':
-                        output = [plain_tags]
-                    elif batch_output_action_on_conflict == 'prepend':
-                        output.insert(0, plain_tags)
-                    else:
-                        output.append(plain_tags)
-
-                    output_path.write_text(' '.join(output))
+                    submit_write(write_caption, output_path, plain_tags)
 
                     if batch_output_save_json:
-                        output_path.with_suffix('.json').write_text(
-                            json.dumps([ratings, tags])
+                        submit_write(
+                            output_path.with_suffix('.json').write_bytes,
+                            json_dumps([ratings, tags])
                         )
 
-                print('all done :)')
+                tagger_workers = getattr(shared.cmd_opts, 'tagger_workers', 1)
+
+                if (
+                    tagger_workers > 1
+                    and use_cpu
+                    and isinstance(interrogator, WaifuDiffusionInterrogator)
+                ):
+                    # shard the batch across worker processes, each with its
+                    # own single-threaded CPU session (see tagger.worker);
+                    # independent sessions scale better than one session
+                    # with many intra-op threads. only worth it when the
+                    # interrogation already runs on CPU; with CUDA we fall
+                    # through to the threaded pipeline instead
+                    model_path, tags_path = interrogator.download()
+
+                    # --wd14-quantize applies here too; the quantized file is
+                    # cached on disk, so the workers just load it
+                    quantize_mode = getattr(
+                        shared.cmd_opts, 'wd14_quantize', 'none')
+                    if quantize_mode != 'none':
+                        model_path = interrogator.quantize(
+                            model_path, quantize_mode)
+
+                    try:
+                        jobs = []
+
+                        for path in paths:
+                            resolved = resolve_output(path)
+
+                            if resolved is not None:
+                                jobs.append((path, resolved))
+                    except (TypeError, ValueError) as error:
+                        writer.shutdown()
+                        return ['', None, None, str(error)]
+
+                    shards = [jobs[i::tagger_workers] for i in range(tagger_workers)]
+                    shards = [shard for shard in shards if shard]
+
+                    if shards:
+                        with ProcessPoolExecutor(
+                            max_workers=len(shards),
+                            mp_context=get_context('spawn'),
+                            initializer=worker.init_worker,
+                            initargs=(str(model_path), str(tags_path))
+                        ) as pool:
+                            shard_futures = {
+                                pool.submit(
+                                    worker.run_shard,
+                                    [str(job[0]) for job in shard]
+                                ): shard
+                                for shard in shards
+                            }
+
+                            for future in as_completed(shard_futures):
+                                shard = shard_futures[future]
+
+                                pairs = [
+                                    (job, result)
+                                    for job, result in zip(shard, future.result())
+                                    if result is not None
+                                ]
+
+                                processed_batch = Interrogator.postprocess_tags_batch(
+                                    [result[1] for _, result in pairs],
+                                    *postprocess_opts
+                                )
+
+                                for (job, (ratings, tags)), processed_tags \
+                                        in zip(pairs, processed_batch):
+                                    write_result(
+                                        *job, ratings, tags, processed_tags)
+
+                    # make sure every pending write hit the disk
+                    writer.shutdown(wait=True)
+
+                    write_error = first_write_error()
+                    if write_error is not None:
+                        return ['', None, None, write_error]
+
+                    print(f'processed {processed} image(s), all done :)')
+                    return ['', None, None, '']
+
+                # (path, output path, buffer slot)
+                pending: List[tuple] = []
+
+                def flush_pending():
+                    # one model call for the whole batch, so the runtime can
+                    # pack a larger GEMM instead of N batch-1 dispatches
+                    images = np.stack([buffers[p[2]] for p in pending])
+                    results = interrogator.interrogate_batch(images)
+
+                    processed_batch = Interrogator.postprocess_tags_batch(
+                        [tags for _, tags in results],
+                        *postprocess_opts
+                    )
+
+                    for (path, output_path, _), (ratings, tags), processed_tags \
+                            in zip(pending, results, processed_batch):
+                        write_result(
+                            path, output_path, ratings, tags, processed_tags)
+
+                    for p in pending:
+                        free_slots.append(p[2])
+
+                    pending.clear()
+
+                def load_and_preprocess(path, slot):
+                    try:
+                        image = Image.open(path)
+                    except UnidentifiedImageError:
+                        # just in case, user has mysterious file...
+                        print(f'${path} is not supported image type')
+                        return False
+
+                    if image.format == 'JPEG':
+                        # let libjpeg decode at 1/2, 1/4... scale; the result
+                        # stays larger than the model input, which only needs
+                        # draft_size pixels anyway
+                        image.draft('RGB', (draft_size, draft_size))
+
+                    interrogator.preprocess_into(image, buffers[slot])
+                    return True
+
+                # load the model up front so worker threads don't race to it
+                if interrogator.model is None:
+                    interrogator.load()
+
+                # decode and preprocess a sliding window of images in worker
+                # threads while the main thread runs inference; PIL and cv2
+                # release the GIL, so this overlaps almost completely
+                executor = ThreadPoolExecutor(max_workers=os.cpu_count())
+
+                # cap the window to bound memory on huge batches
+                prefetch = batch_size * 2
+
+                # persistent ring of preprocess buffers, one row per
+                # in-flight image, so no per-image tensor is allocated
+                ring_size = prefetch + batch_size
+                buffers = np.empty(
+                    (ring_size, *interrogator.input_shape()),
+                    dtype=np.float32
+                )
+                free_slots = deque(range(ring_size))
+
+                # huge JPEGs can be decoded pre-downscaled as long as they
+                # stay comfortably above the model input size
+                draft_size = max(buffers.shape[1], 512)
+
+                path_iter = iter(paths)
+                window = deque()
+
+                def submit_more():
+                    while len(window) < prefetch and free_slots:
+                        next_path = next(path_iter, None)
+
+                        if next_path is None:
+                            break
+
+                        resolved = resolve_output(next_path)
+
+                        if resolved is None:
+                            continue
+
+                        slot = free_slots.popleft()
+
+                        window.append((
+                            next_path,
+                            resolved,
+                            slot,
+                            executor.submit(load_and_preprocess, next_path, slot)
+                        ))
+
+                try:
+                    submit_more()
+
+                    while window:
+                        path, output_path, slot, future = window.popleft()
+                        submit_more()
+
+                        if not future.result():
+                            free_slots.append(slot)
+                            continue
+
+                        pending.append((
+                            path,
+                            output_path,
+                            slot
+                        ))
+
+                        if len(pending) >= batch_size:
+                            flush_pending()
+
+                            # flushing released a batch worth of buffers
+                            submit_more()
+
+                    if pending:
+                        flush_pending()
+                except (TypeError, ValueError) as error:
+                    executor.shutdown(wait=False)
+                    writer.shutdown()
+                    return ['', None, None, str(error)]
+
+                executor.shutdown()
+
+                # make sure every pending write hit the disk
+                writer.shutdown(wait=True)
+
+                write_error = first_write_error()
+                if write_error is not None:
+                    return ['', None, None, write_error]
+
+                print(f'processed {processed} image(s), all done :)')
 
             return ['', None, None, '']
 
@@ -442,6 +820,7 @@ def on_ui_tabs():
                     batch_output_filename_format,
                     batch_output_action_on_conflict,
                     batch_output_save_json,
+                    batch_size,
 
                     # options
                     interrogator,
@@ -1,26 +1,41 @@
 import re
 import hashlib
 
-from typing import Dict, Callable, NamedTuple
+from typing import Dict, Callable, List, Union
 from pathlib import Path
 
 
-class Info(NamedTuple):
-    path: Path
-    output_ext: str
+class Info:
+    def __init__(self, path: Path, output_ext: str) -> None:
+        self.path = path
+        self.output_ext = output_ext
+
+        # digests are memoized per file, so repeated [hash:...] tokens
+        # in the format string only read the file once
+        self._digests: Dict[str, str] = {}
 
 
 def hash(i: Info, algo='sha1') -> str:
+    if algo in i._digests:
+        return i._digests[algo]
+
     try:
-        hash = hashlib.new(algo)
-    except ImportError:
-        raise ValueError(f"'{algo}' is invalid hash algorithm")
+        with open(i.path, 'rb') as file:
+            if hasattr(hashlib, 'file_digest'):  # python 3.11+
+                digest = hashlib.file_digest(file, algo).hexdigest()
+            else:
+                # stream the file in chunks instead of reading it whole
+                hash = hashlib.new(algo)
 
-    # TODO: is okay to hash large image?
-    with open(i.path, 'rb') as file:
-        hash.update(file.read())
+                for chunk in iter(lambda: file.read(8 * 1024 * 1024), b''):
+                    hash.update(chunk)
 
-    return hash.hexdigest()
+                digest = hash.hexdigest()
+    except (ImportError, ValueError):
+        raise ValueError(f"'{algo}' is invalid hash algorithm")
+
+    i._digests[algo] = digest
+    return digest
 
 
 pattern = re.compile(r'\[([\w:]+)\]')
@@ -44,3 +59,31 @@ def format(match: re.Match, info: Info) -> str:
         return match[0]
 
     return available_formats[name](info, *args)
+
+
+def compile(format_string: str) -> List[Union[str, Callable[[Info], str]]]:
+    # one regex scan at compile time; pattern.split interleaves literals
+    # with the captured token names, and the format function plus its
+    # arguments are resolved here so emission is a plain join
+    tokens = pattern.split(format_string)
+    segments: List[Union[str, Callable[[Info], str]]] = []
+
+    for i, token in enumerate(tokens):
+        if i % 2 == 0:
+            if token:
+                segments.append(token)
+            continue
+
+        name, *args = token.split(':')
+
+        if name not in available_formats:
+            # unknown names are kept verbatim, brackets included
+            segments.append(f'[{token}]')
+            continue
+
+        segments.append(
+            lambda info, func=available_formats[name], args=args:
+                func(info, *args)
+        )
+
+    return segments
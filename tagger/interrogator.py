@@ -31,6 +31,24 @@ else:
             print('--device-id is not a integer')
 
 
+# numba is optional; without it the kernel below runs as plain NumPy
+try:
+    from numba import njit
+except ImportError:
+    def njit(*args, **kwargs):
+        def decorator(func):
+            return func
+        return decorator
+
+
+@njit(cache=True, fastmath=True)
+def _filter_sort(confidents: np.ndarray, threshold: float) -> np.ndarray:
+    # surviving tag indices, highest confident first
+    idx = np.nonzero(confidents >= threshold)[0]
+    order = np.argsort(-confidents[idx])
+    return idx[order]
+
+
 class Interrogator:
     @staticmethod
     def postprocess_tags(
@@ -86,6 +104,71 @@ class Interrogator:
 
         return tags
 
+    @staticmethod
+    def postprocess_tags_batch(
+        tags_batch: List[Dict[str, float]],
+
+        threshold=0.35,
+        additional_tags: List[str] = [],
+        exclude_tags: List[str] = [],
+        sort_by_alphabetical_order=False,
+        add_confident_as_weight=False,
+        replace_underscore=False,
+        replace_underscore_excludes: List[str] = [],
+        escape_tag=False
+    ) -> List[Dict[str, float]]:
+        if len(tags_batch) < 1:
+            return []
+
+        # every image in a batch shares the model's tag vocabulary,
+        # so thresholding can run as one NumPy mask over a (batch, tag)
+        # array instead of a Python comparison per tag per image
+        tag_names = list(tags_batch[0])
+        confidents = np.empty(
+            (len(tags_batch), len(tag_names)),
+            dtype=np.float32
+        )
+
+        for i, tags in enumerate(tags_batch):
+            confidents[i] = np.fromiter(tags.values(), np.float32, len(tags))
+
+        # additional tags the model knows must keep their model confidence
+        # even below threshold, so postprocess_tags drops them exactly like
+        # it does in the single-image path
+        additional_idxs = []
+        if additional_tags:
+            name_idx = {name: i for i, name in enumerate(tag_names)}
+            additional_idxs = [
+                name_idx[t] for t in additional_tags if t in name_idx
+            ]
+
+        results = []
+
+        for row, tags in enumerate(tags_batch):
+            # JIT'd threshold + sort over the raw confident vector
+            survived = {
+                tag_names[i]: float(confidents[row, i])
+                for i in _filter_sort(confidents[row], threshold)
+            }
+
+            for i in additional_idxs:
+                survived.setdefault(tag_names[i], float(confidents[row, i]))
+
+            # the string postprocessing only touches the surviving subset
+            results.append(Interrogator.postprocess_tags(
+                survived,
+                threshold,
+                additional_tags,
+                exclude_tags,
+                sort_by_alphabetical_order,
+                add_confident_as_weight,
+                replace_underscore,
+                replace_underscore_excludes,
+                escape_tag
+            ))
+
+        return results
+
     def interrogate(
         self,
         image: Image
@@ -95,6 +178,31 @@ class Interrogator:
     ]:
         pass
 
+    def preprocess(
+        self,
+        image: Image
+    ) -> np.ndarray:  # (height, width, channel)
+        pass
+
+    def preprocess_into(
+        self,
+        image: Image,
+        out: np.ndarray
+    ) -> None:
+        np.copyto(out, self.preprocess(image), casting='unsafe')
+
+    def input_shape(self) -> Tuple[int, int, int]:  # (height, width, channel)
+        pass
+
+    def interrogate_batch(
+        self,
+        images: np.ndarray  # (batch, height, width, channel)
+    ) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        pass
+
 
 class DeepDanbooruInterrogator(Interrogator):
     def __init__(self,  project_path: os.PathLike) -> None:
@@ -136,13 +244,10 @@ class DeepDanbooruInterrogator(Interrogator):
                 project_path=self.project_path
             )
 
-    def interrogate(
+    def preprocess(
         self,
         image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
+    ) -> np.ndarray:
         # init model
         if self.model is None:
             self.load()
@@ -152,25 +257,58 @@ class DeepDanbooruInterrogator(Interrogator):
         # convert an image to fit the model
         image_bufs = BytesIO()
         image.save(image_bufs, format='PNG')
-        image = ddd.load_image_for_evaluate(
+        return ddd.load_image_for_evaluate(
             image_bufs,
             self.model.input_shape[2],
             self.model.input_shape[1]
         )
 
+    def input_shape(self) -> Tuple[int, int, int]:
+        # init model
+        if self.model is None:
+            self.load()
+
+        return tuple(self.model.input_shape[1:4])
+
+    def interrogate(
+        self,
+        image: Image
+    ) -> Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]:
+        image = self.preprocess(image)
         image = image.reshape((1, *image.shape[0:3]))
 
-        # evaluate model
-        result = self.model.predict(image)
+        return self.interrogate_batch(image)[0]
+
+    def interrogate_batch(
+        self,
+        images: np.ndarray
+    ) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        # init model
+        if self.model is None:
+            self.load()
+
+        # evaluate model with a single batched call
+        result = self.model.predict(images)
+
+        results = []
 
-        confidents = result[0].tolist()
-        ratings = {}
-        tags = {}
+        for confidents in result:
+            confidents = confidents.tolist()
+            ratings = {}
+            tags = {}
 
-        for i, tag in enumerate(self.tags):
-            tags[tag] = confidents[i]
+            for i, tag in enumerate(self.tags):
+                tags[tag] = confidents[i]
 
-        return ratings, tags
+            results.append((ratings, tags))
+
+        return results
 
 
 class WaifuDiffusionInterrogator(Interrogator):
@@ -193,6 +331,39 @@ class WaifuDiffusionInterrogator(Interrogator):
         tags_path = Path(hf_hub_download(self.repo, filename=self.tags_path))
         return model_path, tags_path
 
+    def quantize(self, model_path: Path, mode: str) -> Path:
+        # cache the quantized model next to the original,
+        # so it only has to be converted once per download
+        quantized_path = model_path.with_name(f'{model_path.stem}.{mode}.onnx')
+
+        if quantized_path.is_file():
+            return quantized_path
+
+        print(f'Quantizing Waifu Diffusion tagger model to {mode}')
+
+        if mode == 'int8':
+            from onnxruntime.quantization import QuantType, quantize_dynamic
+
+            quantize_dynamic(
+                model_path,
+                quantized_path,
+                weight_type=QuantType.QInt8
+            )
+        else:  # fp16
+            from launch import is_installed, run_pip
+            if not is_installed('onnxconverter_common'):
+                run_pip(
+                    'install onnx onnxconverter-common', 'onnxconverter-common')
+
+            import onnx
+            from onnxconverter_common import float16
+
+            model = onnx.load(str(model_path))
+            model = float16.convert_float_to_float16(model, keep_io_types=True)
+            onnx.save(model, str(quantized_path))
+
+        return quantized_path
+
     def load(self) -> None:
         model_path, tags_path = self.download()
 
@@ -208,7 +379,16 @@ class WaifuDiffusionInterrogator(Interrogator):
 
             run_pip(f'install {package}', 'onnxruntime')
 
-        from onnxruntime import InferenceSession
+        from onnxruntime import (
+            GraphOptimizationLevel, InferenceSession, SessionOptions)
+
+        quantize_mode = getattr(shared.cmd_opts, 'wd14_quantize', 'none')
+        if quantize_mode != 'none':
+            model_path = self.quantize(model_path, quantize_mode)
+
+        sess_options = SessionOptions()
+        sess_options.graph_optimization_level = \
+            GraphOptimizationLevel.ORT_ENABLE_ALL
 
         # https://onnxruntime.ai/docs/execution-providers/
         # https://github.com/toriato/stable-diffusion-webui-wd14-tagger/commit/e4ec460122cf674bbf984df30cdb10b4370c1224#r92654958
@@ -216,29 +396,35 @@ class WaifuDiffusionInterrogator(Interrogator):
         if use_cpu:
             providers.pop(0)
 
-        self.model = InferenceSession(str(model_path), providers=providers)
+        self.model = InferenceSession(
+            str(model_path),
+            sess_options,
+            providers=providers
+        )
 
         print(f'Loaded Waifu Diffusion tagger model from {model_path}')
 
         self.tags = pd.read_csv(tags_path)
 
-    def interrogate(
+    def preprocess(
         self,
         image: Image
-    ) -> Tuple[
-        Dict[str, float],  # rating confidents
-        Dict[str, float]  # tag confidents
-    ]:
-        # init model
-        if self.model is None:
-            self.load()
+    ) -> np.ndarray:
+        out = np.empty(self.input_shape(), dtype=np.float32)
+        self.preprocess_into(image, out)
+        return out
 
-        # code for converting the image and running the model is taken from the link below
+    def preprocess_into(
+        self,
+        image: Image,
+        out: np.ndarray
+    ) -> None:
+        # code for converting the image is taken from the link below
         # thanks, SmilingWolf!
         # https://huggingface.co/spaces/SmilingWolf/wd-v1-4-tags/blob/main/app.py
 
         # convert an image to fit the model
-        _, height, _, _ = self.model.get_inputs()[0].shape
+        height = out.shape[0]
 
         # alpha to white
         image = image.convert('RGBA')
@@ -252,21 +438,59 @@ class WaifuDiffusionInterrogator(Interrogator):
 
         image = dbimutils.make_square(image, height)
         image = dbimutils.smart_resize(image, height)
-        image = image.astype(np.float32)
+
+        # uint8 -> float32 straight into the caller's buffer,
+        # skipping the astype temporary
+        np.copyto(out, image, casting='unsafe')
+
+    def input_shape(self) -> Tuple[int, int, int]:
+        # init model
+        if self.model is None:
+            self.load()
+
+        _, height, _, _ = self.model.get_inputs()[0].shape
+        return height, height, 3
+
+    def interrogate(
+        self,
+        image: Image
+    ) -> Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]:
+        image = self.preprocess(image)
         image = np.expand_dims(image, 0)
 
-        # evaluate model
+        return self.interrogate_batch(image)[0]
+
+    def interrogate_batch(
+        self,
+        images: np.ndarray
+    ) -> List[Tuple[
+        Dict[str, float],  # rating confidents
+        Dict[str, float]  # tag confidents
+    ]]:
+        # init model
+        if self.model is None:
+            self.load()
+
+        # evaluate model, one session run for the whole batch
         input_name = self.model.get_inputs()[0].name
         label_name = self.model.get_outputs()[0].name
-        confidents = self.model.run([label_name], {input_name: image})[0]
+        confidents = self.model.run([label_name], {input_name: images})[0]
+
+        results = []
+
+        for confident in confidents:
+            tags = self.tags[:][['name']]
+            tags['confidents'] = confident
 
-        tags = self.tags[:][['name']]
-        tags['confidents'] = confidents[0]
+            # first 4 items are for rating (general, sensitive, questionable, explicit)
+            ratings = dict(tags[:4].values)
 
-        # first 4 items are for rating (general, sensitive, questionable, explicit)
-        ratings = dict(tags[:4].values)
+            # rest are regular tags
+            tags = dict(tags[4:].values)
 
-        # rest are regular tags
-        tags = dict(tags[4:].values)
+            results.append((ratings, tags))
 
-        return ratings, tags
+        return results
@@ -0,0 +1,97 @@
+# Runs WD14 inference in worker subprocesses for --tagger-workers.
+# This module is imported in spawned processes,
+# so nothing here may touch the web UI.
+
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageFile, UnidentifiedImageError
+
+from . import dbimutils
+
+# PIL spits errors when loading a truncated image by default
+# https://pillow.readthedocs.io/en/stable/reference/ImageFile.html#PIL.ImageFile.LOAD_TRUNCATED_IMAGES
+ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+# per-process state, created once by init_worker
+_model = None
+_tags = None
+_height = None
+
+
+def init_worker(model_path: str, tags_path: str) -> None:
+    global _model, _tags, _height
+
+    from onnxruntime import (
+        GraphOptimizationLevel, InferenceSession, SessionOptions)
+
+    sess_options = SessionOptions()
+    sess_options.graph_optimization_level = \
+        GraphOptimizationLevel.ORT_ENABLE_ALL
+
+    # one single-threaded session per worker; the parallelism comes from
+    # running the shards in independent processes
+    sess_options.intra_op_num_threads = 1
+
+    _model = InferenceSession(
+        model_path,
+        sess_options,
+        providers=['CPUExecutionProvider']
+    )
+
+    _, _height, _, _ = _model.get_inputs()[0].shape
+
+    _tags = pd.read_csv(tags_path)
+
+
+def _preprocess(image: Image.Image) -> np.ndarray:
+    # same conversion as WaifuDiffusionInterrogator.preprocess_into
+    image = image.convert('RGBA')
+    new_image = Image.new('RGBA', image.size, 'WHITE')
+    new_image.paste(image, mask=image)
+    image = new_image.convert('RGB')
+    image = np.asarray(image)
+
+    # PIL RGB to OpenCV BGR
+    image = image[:, :, ::-1]
+
+    image = dbimutils.make_square(image, _height)
+    image = dbimutils.smart_resize(image, _height)
+    return image.astype(np.float32)
+
+
+def run_shard(paths: List[str]) -> List[Optional[Tuple[
+    Dict[str, float],  # rating confidents
+    Dict[str, float]  # tag confidents
+]]]:
+    results = []
+
+    for path in paths:
+        try:
+            image = Image.open(path)
+        except UnidentifiedImageError:
+            # just in case, user has mysterious file...
+            print(f'${path} is not supported image type')
+            results.append(None)
+            continue
+
+        if image.format == 'JPEG':
+            # let libjpeg decode at 1/2, 1/4... scale; the result stays
+            # comfortably above the model input size
+            draft_size = max(_height, 512)
+            image.draft('RGB', (draft_size, draft_size))
+
+        image = np.expand_dims(_preprocess(image), 0)
+
+        input_name = _model.get_inputs()[0].name
+        label_name = _model.get_outputs()[0].name
+        confidents = _model.run([label_name], {input_name: image})[0]
+
+        tags = _tags[:][['name']]
+        tags['confidents'] = confidents[0]
+
+        # first 4 items are for rating (general, sensitive, questionable, explicit)
+        results.append((dict(tags[:4].values), dict(tags[4:].values)))
+
+    return results